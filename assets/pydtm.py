@@ -17,18 +17,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import atexit
 import collections
 import ctypes
 import fcntl
 import logging
 import os
 import select
+import signal
 import socket
+import sys
 import time
 import datetime
-import timeit
 import json
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
 
 # init logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
@@ -50,6 +53,8 @@ DTV_MODULATION = 0x4
 DTV_SYMBOL_RATE = 0x8
 DTV_TUNE = 0x1
 FEC_AUTO = 0x9
+FE_GET_EVENT = -0x7FD790B2  # ioctl
+FE_HAS_LOCK = 0x10
 FE_READ_STATUS = -0x7FFB90BB  # ioctl
 FE_SET_PROPERTY = 0x40086F52  # ioctl
 INVERSION_OFF = 0x0
@@ -57,6 +62,20 @@ QAM_256 = 0x5
 QAM_64 = 0x3
 SYS_DVBC_ANNEX_AC = 0x1
 
+# seconds to wait for a frontend event before discarding stale DVR data again
+LOCK_POLL_INTERVAL = 0.02
+
+# maximum number of reads per DVR wake-up before checking the deadline again
+DVR_DRAIN_LIMIT = 16
+
+# size of a single MPEG-TS packet in bytes
+TS_PACKET_SIZE = 188
+
+# InfluxDB write batching: flush once this many points are pending and never
+# hold more than INFLUX_MAX_PENDING points if the database is unreachable
+INFLUX_BATCH_SIZE = 500
+INFLUX_MAX_PENDING = 10000
+
 # mappings for DVB API data types - this code was copied
 # more or less verbatim from: https://pypi.org/project/linuxdvb/
 class dtv_property(ctypes.Structure):
@@ -92,9 +111,22 @@ class dvb_qam_parameters(ctypes.Structure):
     ]
 
 
+class dvb_ofdm_parameters(ctypes.Structure):
+    _fields_ = [
+        ("bandwidth", ctypes.c_uint),
+        ("code_rate_HP", ctypes.c_uint),
+        ("code_rate_LP", ctypes.c_uint),
+        ("constellation", ctypes.c_uint),
+        ("transmission_mode", ctypes.c_uint),
+        ("guard_interval", ctypes.c_uint),
+        ("hierarchy_information", ctypes.c_uint),
+    ]
+
+
 class dvb_frontend_parameters(ctypes.Structure):
     class _u(ctypes.Union):
-        _fields_ = [("qam", dvb_qam_parameters)]
+        # ofdm is the largest member and determines the size of the union
+        _fields_ = [("qam", dvb_qam_parameters), ("ofdm", dvb_ofdm_parameters)]
 
     _fields_ = [("frequency", ctypes.c_uint32), ("inversion", ctypes.c_uint), ("u", _u)]
 
@@ -103,6 +135,10 @@ class dvb_frontend_status(ctypes.Structure):
     _fields_ = [("status", ctypes.c_uint)]
 
 
+class dvb_frontend_event(ctypes.Structure):
+    _fields_ = [("status", ctypes.c_uint), ("parameters", dvb_frontend_parameters)]
+
+
 class dmx_pes_filter_params(ctypes.Structure):
     _fields_ = [
         ("pid", ctypes.c_uint16),
@@ -119,6 +155,72 @@ class dmx_pes_filter_params(ctypes.Structure):
 # in setting a frequency and a modulation
 Tunable = collections.namedtuple("Tunable", ["frequency", "modulation"])
 
+# translate human readable modulations to the DVB API and DVB API modulations to labels
+MODULATIONS = {"256": QAM_256, "64": QAM_64}
+MODULATION_LABELS = {QAM_256: "qam256", QAM_64: "qam64"}
+
+# we issue 7 commands to the DVB frontend when tuning, all but the modulation and the
+# frequency are the same every time, so build the property array only once
+_TUNE_PROP = (dtv_property * 7)()
+# set delivery system to DVB-C
+_TUNE_PROP[0].cmd = DTV_DELIVERY_SYSTEM
+_TUNE_PROP[0].u.data = SYS_DVBC_ANNEX_AC
+# set modulation
+# TODO: support QAM_AUTO?
+_TUNE_PROP[1].cmd = DTV_MODULATION
+# set EuroDOCSIS symbol rate
+_TUNE_PROP[2].cmd = DTV_SYMBOL_RATE
+_TUNE_PROP[2].u.data = 6952000
+# DOCSIS profiles always set frequency inversion to off
+_TUNE_PROP[3].cmd = DTV_INVERSION
+_TUNE_PROP[3].u.data = INVERSION_OFF
+# autodetect Forward Error Correction
+_TUNE_PROP[4].cmd = DTV_INNER_FEC
+_TUNE_PROP[4].u.data = FEC_AUTO
+# set frequency
+_TUNE_PROP[5].cmd = DTV_FREQUENCY
+# tell the kernel to actually tune into the given frequency
+_TUNE_PROP[6].cmd = DTV_TUNE
+_TUNE_PROPS = dtv_properties(
+    num=7, props=ctypes.cast(_TUNE_PROP, ctypes.POINTER(dtv_property))
+)
+
+# frontend status, filled by FE_READ_STATUS
+_FE_STATUS = dvb_frontend_status()
+
+# frontend event, filled by FE_GET_EVENT
+_FE_EVENT = dvb_frontend_event()
+
+# DOCSIS uses the MPEG-TS Packet Identifier 8190
+# tell the demuxer to get us the transport stream
+_PES_FILTER = dmx_pes_filter_params(
+    pid=8190,
+    input=DMX_IN_FRONTEND,
+    output=DMX_OUT_TS_TAP,
+    pes_type=DMX_PES_OTHER,
+    flags=DMX_IMMEDIATE_START,
+)
+
+
+class DvrPoller:
+    """wait for a single fd to become readable, using epoll if available and poll otherwise"""
+
+    def __init__(self, fd):
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._mask = select.EPOLLIN | select.EPOLLPRI
+            # epoll takes seconds, poll milliseconds
+            self._scale = 1
+        else:
+            self._poller = select.poll()
+            self._mask = select.POLLIN | select.POLLPRI
+            self._scale = 1000
+        self._poller.register(fd, self._mask)
+
+    def poll(self, timeout):
+        """wait at most timeout seconds, return whether the fd has data to read"""
+        return any(flag & self._mask for _, flag in self._poller.poll(timeout * self._scale))
+
 
 def parse_arguments():
     """This function parses the command line arguments and return them."""
@@ -128,8 +230,8 @@ def parse_arguments():
         epilog="Note: By default, each frequency is scanned for step/num(frequencies) seconds. "
         "All parameters can also be passed as environment variables, e.g. PYDTM_ADAPTER, "
         "PYDTM_INFLUXDB_HOST, PYDTM_INFLUXDB_PORT, PYDTM_INFLUXDB_TLS, PYDTM_INFLUXDB_USERNAME, PYDTM_INFLUXDB_PASSWORD, "
-        "PYDTM_INFLUXDB_DATABASE, PYDTM_DEBUG, PYDTM_INTERVAL, PYDTM_FREQUENCIES, PYDTM_STEP, PYTDM_TUNER and "
-        "PYDTM_LOCKTIME"
+        "PYDTM_INFLUXDB_DATABASE, PYDTM_INFLUXDB_FLUSH, PYDTM_DEBUG, PYDTM_INTERVAL, PYDTM_FREQUENCIES, PYDTM_STEP, PYTDM_TUNER, "
+        "PYDTM_LOCKTIME and PYDTM_RT"
     )
     # add arguments
     parser.add_argument(
@@ -181,6 +283,13 @@ def parse_arguments():
         default="pydtm",
         help="database name for influxdb (default: pydtm)",
     )
+    parser.add_argument(
+        "-if",
+        "--influx-flush",
+        type=int,
+        default=0,
+        help="amount of seconds to collect points before writing them to influxdb (default: 0)",
+    )
     parser.add_argument(
         "-d",
         "--debug",
@@ -216,7 +325,7 @@ def parse_arguments():
         "--locktime",
         type=int,
         default=1,
-        help="locktime for frontend in sec. (default: 1)",
+        help="maximum time to wait for a frontend lock in sec. (default: 1)",
     )
     parser.add_argument(
         "-i",
@@ -225,6 +334,14 @@ def parse_arguments():
         default=300,
         help="amount of seconds to wait between each scan cycle. (default: 300)",
     )
+    parser.add_argument(
+        "-rt",
+        "--realtime",
+        type=bool,
+        default=False,
+        help="use real-time scheduling and pin to a single CPU, needs CAP_SYS_NICE "
+        "(default: not enabled)",
+    )
 
     # return parsed arguments
     return parser.parse_args()
@@ -232,20 +349,19 @@ def parse_arguments():
 
 def set_from_env(envvar, default):
     """If envar is set, return it, else default"""
-    if envvar in os.environ:
-        return os.environ[envvar]
-    return default
+    return os.environ.get(envvar, default)
 
 
 def eval_envvars(args):
     """Parse environment variables if present."""
     # overwrite with environment values
+    raw = set_from_env("PYDTM_ADAPTER", args.adapter)
     try:
-        args.adapter = int(set_from_env("PYDTM_ADAPTER", args.adapter))
+        args.adapter = int(raw)
     except ValueError:
         LOGGER.error(
             "error parsing PYDTM_ADAPTER value %s as integer, using %d instead",
-            os.environ["PYDTM_ADAPTER"],
+            raw,
             args.adapter,
         )
     args.influx_host = set_from_env("PYDTM_INFLUXDB_HOST", args.influx_host)
@@ -253,12 +369,22 @@ def eval_envvars(args):
     args.influx_username = set_from_env("PYDTM_INFLUXDB_USERNAME", args.influx_username)
     args.influx_password = set_from_env("PYDTM_INFLUXDB_PASSWORD", args.influx_password)
     args.influx_database = set_from_env("PYDTM_INFLUXDB_DATABASE", args.influx_database)
+    raw = set_from_env("PYDTM_INFLUXDB_FLUSH", args.influx_flush)
+    try:
+        args.influx_flush = int(raw)
+    except ValueError:
+        LOGGER.error(
+            "error parsing PYDTM_INFLUXDB_FLUSH value %s as integer, using %d instead",
+            raw,
+            args.influx_flush,
+        )
+    raw = set_from_env("PYDTM_LOCKTIME", args.locktime)
     try:
-        args.locktime = int(set_from_env("PYDTM_LOCKTIME", args.locktime))
+        args.locktime = int(raw)
     except ValueError:
         LOGGER.error(
             "error parsing PYDTM_LOCKTIME value %s as integer, using %d instead",
-            os.environ["PYDTM_LOCKTIME"],
+            raw,
             args.locktime,
         )
 
@@ -268,33 +394,39 @@ def eval_envvars(args):
     if "PYDTM_DEBUG" in os.environ:
         args.debug = True
 
+    if "PYDTM_RT" in os.environ:
+        args.realtime = True
+
     args.frequencies = set_from_env("PYDTM_FREQUENCIES", args.frequencies)
 
+    raw = set_from_env("PYDTM_STEP", args.step)
     try:
-        args.step = int(set_from_env("PYDTM_STEP", args.step))
+        args.step = int(raw)
     except ValueError:
         LOGGER.error(
             "error parsing PYDTM_STEP value %s as integer, using %d instead",
-            os.environ["PYDTM_STEP"],
+            raw,
             args.step,
         )
 
+    raw = set_from_env("PYDTM_TUNER", args.tuner)
     try:
-        args.tuner = int(set_from_env("PYDTM_TUNER", args.tuner))
+        args.tuner = int(raw)
     except ValueError:
         LOGGER.error(
             "error parsing PYDTM_TUNER value %s as integer, using %d instead",
-            os.environ["PYDTM_TUNER"],
+            raw,
             args.tuner,
         )
 
+    raw = set_from_env("PYDTM_INTERVAL", args.interval)
     try:
-        args.interval = int(set_from_env("PYDTM_INTERVAL", args.interval))
+        args.interval = int(raw)
     except ValueError:
         LOGGER.error(
             "error parsing PYDTM_INTERVAL value %s as integer, using %d instead",
-            os.environ["PYDTM_INTERVAL"],
-            args.step,
+            raw,
+            args.interval,
         )
 
 def frequency_list(frequencies):
@@ -311,20 +443,27 @@ def frequency_list(frequencies):
             freq = int(freq)
         except ValueError:
             LOGGER.critical("error parsing frequency %s as integer, aborting", freq)
-            exit(1)
+            sys.exit(1)
 
         # generate list of tunable frequency/modulation combinations, translate human readable
         # modulation to DVB API
-        if mod == "256":
-            f_list.append(Tunable(freq, QAM_256))
-        elif mod == "64":
-            f_list.append(Tunable(freq, QAM_64))
-        else:
+        if mod not in MODULATIONS:
             LOGGER.critical("invalid modulation QAM_%s detected, aborting", mod)
-            exit(1)
+            sys.exit(1)
+        f_list.append(Tunable(freq, MODULATIONS[mod]))
     return f_list
 
 
+def influx_tags(tunable):
+    """build the influxdb tags for a given frequency"""
+    m_type = MODULATION_LABELS[tunable.modulation]
+    return {
+        "name": "{}.{}".format(m_type, tunable.frequency),
+        "frequency": tunable.frequency,
+        "modulation": m_type,
+    }
+
+
 def build_configuration():
     """Build basic configuration."""
     # parse command line arguments first, then evaluate environment
@@ -350,10 +489,30 @@ def build_configuration():
             len(frequencies),
         )
 
+    # the frequency list can't change at runtime, keep the parsed version around
+    args.frequency_tunables = frequencies
+
     return args
 
 
-def tune(fefd, tunable, locktime, num, total):
+def enable_realtime():
+    """request real-time scheduling and pin the process to a single CPU"""
+    # a preempted reader lets the demuxer buffer overflow on slow hardware
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(20))
+    except PermissionError:
+        LOGGER.warning("unable to enable real-time scheduling, CAP_SYS_NICE is required")
+    # avoid migrations between CPUs
+    cpu = max(os.sched_getaffinity(0))
+    try:
+        os.sched_setaffinity(0, {cpu})
+    except OSError as e:
+        LOGGER.warning("unable to pin process to CPU %d: %s", cpu, e)
+    else:
+        LOGGER.debug("pinned process to CPU %d", cpu)
+
+
+def tune(fefd, tunable, num, total):
     """tune to given frequency"""
     LOGGER.debug(
         "%d/%d: tuning to frequency %dMHz with modulation %d",
@@ -362,65 +521,78 @@ def tune(fefd, tunable, locktime, num, total):
         tunable.frequency,
         tunable.modulation,
     )
-    # we are about to issue 7 commands to the DVB frontend
-    proptype = dtv_property * 7
-    prop = proptype()
-    # set delivery system to DVB-C
-    prop[0].cmd = DTV_DELIVERY_SYSTEM
-    prop[0].u.data = SYS_DVBC_ANNEX_AC
-    # set modulation
-    # TODO: support QAM_AUTO?
-    prop[1].cmd = DTV_MODULATION
-    prop[1].u.data = tunable.modulation
-    # set EuroDOCSIS symbol rate
-    prop[2].cmd = DTV_SYMBOL_RATE
-    prop[2].u.data = 6952000
-    # DOCSIS profiles always set frequency inversion to off
-    prop[3].cmd = DTV_INVERSION
-    prop[3].u.data = INVERSION_OFF
-    # autodetect Forward Error Correction
-    prop[4].cmd = DTV_INNER_FEC
-    prop[4].u.data = FEC_AUTO
-    # set frequency
-    prop[5].cmd = DTV_FREQUENCY
-    prop[5].u.data = tunable.frequency * 1000000
-    # tell the kernel to actually tune into the given frequency
-    prop[6].cmd = DTV_TUNE
-    dtv_props = dtv_properties()
-    dtv_props.num = 7
-    dtv_props.props = ctypes.pointer(prop[0])
-    if fcntl.ioctl(fefd, FE_SET_PROPERTY, dtv_props) == 0:
-        # determine wheter the frontend actually has a lock
-        # FIXME: why do I need this?
-        time.sleep(locktime)
-        # make sure the FE has a lock
-        festatus = dvb_frontend_status()
-        if fcntl.ioctl(fefd, FE_READ_STATUS, festatus) == 0:
-            if (festatus.status & 0x10) == 0:
-                LOGGER.error("  frontend has no lock")
-                return -1
-        else:
-            LOGGER.error("  FE_READ_STATUS failed, unable to verify signal lock")
-            return -1
-    else:
-        LOGGER.error("  FE_SET_PROPERTY failed, unable to tune")
+    # only modulation and frequency change between calls
+    _TUNE_PROP[1].u.data = tunable.modulation
+    _TUNE_PROP[5].u.data = tunable.frequency * 1000000
+    try:
+        fcntl.ioctl(fefd, FE_SET_PROPERTY, _TUNE_PROPS)
+    except OSError as e:
+        LOGGER.error("  FE_SET_PROPERTY failed, unable to tune: %s", e)
         return -1
-    LOGGER.debug("  tuning successful")
     return 0
 
 
+def has_lock(fefd):
+    """check whether the frontend currently has a lock"""
+    try:
+        fcntl.ioctl(fefd, FE_READ_STATUS, _FE_STATUS)
+    except OSError as e:
+        LOGGER.error("  FE_READ_STATUS failed, unable to verify signal lock: %s", e)
+        return False
+    return bool(_FE_STATUS.status & FE_HAS_LOCK)
+
+
+def wait_for_lock(fefd, fe_poller, dvrfd, mv, locktime):
+    """wait for the frontend to lock, discarding stale DVR data in the meantime"""
+    deadline = time.monotonic() + locktime
+    stale = 0
+    # the frontend queues an event for every status change and usually locks a lot
+    # faster than locktime, so wait for the event and only give up once locktime is over
+    while True:
+        # whatever is still buffered belongs to the previous frequency, get rid of it
+        # while the frontend settles instead of counting it for the new one
+        stale += drain_dvr(dvrfd, mv)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if fe_poller.poll(min(remaining, LOCK_POLL_INTERVAL) * 1000):
+            try:
+                fcntl.ioctl(fefd, FE_GET_EVENT, _FE_EVENT)
+            except OSError as e:
+                # EOVERFLOW means events were lost, the next one will tell
+                LOGGER.debug("  FE_GET_EVENT failed: %s", e)
+                continue
+            if _FE_EVENT.status & FE_HAS_LOCK:
+                LOGGER.debug("  tuning successful, discarded %d stale bytes", stale)
+                return 0
+    # no lock event within locktime, make sure the FE really has no lock
+    if not has_lock(fefd):
+        LOGGER.error("  frontend has no lock")
+        return -1
+    LOGGER.debug("  tuning successful, discarded %d stale bytes", stale)
+    return 0
+
+
+def drain_dvr(dvrfd, mv, limit=None):
+    """read what the DVR has buffered (at most limit reads), return the number of bytes read"""
+    count = 0
+    reads = 0
+    while limit is None or reads < limit:
+        reads += 1
+        try:
+            n = dvrfd.readinto(mv)
+        except BlockingIOError:
+            break
+        if n is None or n <= 0:
+            break
+        count += n
+    return count
+
+
 def start_demuxer(dmxfd):
     """start demuxer"""
-    # DOCSIS uses the MPEG-TS Packet Identifier 8190
-    # tell the demuxer to get us the transport stream
     LOGGER.debug("  starting demuxer")
-    pesfilter = dmx_pes_filter_params()
-    pesfilter.pid = 8190
-    pesfilter.input = DMX_IN_FRONTEND
-    pesfilter.output = DMX_OUT_TS_TAP
-    pesfilter.pes_type = DMX_PES_OTHER
-    pesfilter.flags = DMX_IMMEDIATE_START
-    if fcntl.ioctl(dmxfd, DMX_SET_PES_FILTER, pesfilter) != 0:
+    if fcntl.ioctl(dmxfd, DMX_SET_PES_FILTER, _PES_FILTER) != 0:
         LOGGER.error("  unable to start demuxer")
         return -1
     LOGGER.debug("  demuxer initialization successful")
@@ -436,6 +608,43 @@ def stop_demuxer(dmxfd):
     return 0
 
 
+def write_pending(client, pending_points):
+    """write pending points to influxdb, return False if they should be retried later"""
+    if not pending_points:
+        return True
+    LOGGER.info("Sending %d points to database...", len(pending_points))
+    try:
+        client.write_points(
+            list(pending_points), time_precision='ms', batch_size=INFLUX_BATCH_SIZE
+        )
+    except InfluxDBClientError as e:
+        # 4xx responses won't succeed on a retry either, keeping the points would only
+        # block everything collected after them
+        if e.code is not None and 400 <= e.code < 500:
+            LOGGER.error(
+                f"Database rejected {len(pending_points)} points, dropping them: {e}"
+            )
+            pending_points.clear()
+            return True
+        LOGGER.error(
+            f"Error sending to database: {e}"
+        )
+        return False
+    except Exception as e:
+        LOGGER.error(
+            f"Error sending to database: {e}"
+        )
+        return False
+    pending_points.clear()
+    return True
+
+
+def handle_sigterm(signum, frame):
+    """exit regularly on SIGTERM, so pending points are still written"""
+    LOGGER.info("Received SIGTERM, shutting down")
+    sys.exit(0)
+
+
 def main():
     """run main program"""
     LOGGER.info("+++ Welcome to pydtm - Python (Euro)DOCSIS (3.0) Traffic Meter! +++ ")
@@ -448,6 +657,11 @@ def main():
         LOGGER.setLevel(logging.INFO)
     else:
         LOGGER.setLevel(logging.DEBUG)
+    # checked for every frequency, so avoid going through the logging machinery
+    debug_enabled = config.debug
+
+    if config.realtime:
+        enable_realtime()
 
     # dbconnection
     try:
@@ -458,7 +672,9 @@ def main():
             verify_ssl=config.influx_tls,
             username=config.influx_username,
             password=config.influx_password,
-            database=config.influx_database
+            database=config.influx_database,
+            # a single connection is reused for all writes
+            pool_size=1,
         )
 
         client.ping()
@@ -466,139 +682,207 @@ def main():
         LOGGER.error(
             f"Error connecting to influxdb: {e}"
         )
-        exit()
+        sys.exit(1)
     
 
     # open the frontend device, demuxer and DVR device
     config.adapter = "/dev/dvb/adapter" + str(config.adapter)
     with open(config.adapter + "/frontend" + str(config.tuner), "r+") as fefd, open(
         config.adapter + "/demux" + str(config.tuner), "r+"
-    ) as dmxfd, open(config.adapter + "/dvr" + str(config.tuner), "rb") as dvrfd:
-
-        # the demux device needs to be opened non blocking
-        flag = fcntl.fcntl(dvrfd, fcntl.F_GETFL)
-        fcntl.fcntl(dvrfd, fcntl.F_SETFL, flag | os.O_NONBLOCK)
-
-        # we will need to poll the DVR
-        dvr_poller = select.poll()
-        dvr_poller.register(dvrfd, select.POLLIN | select.POLLPRI)
+    ) as dmxfd, os.fdopen(
+        # the DVR is drained until EAGAIN, so it is opened non blocking right away instead of
+        # changing the flags afterwards
+        os.open(config.adapter + "/dvr" + str(config.tuner), os.O_RDONLY | os.O_NONBLOCK),
+        "rb",
+        buffering=0,
+    ) as dvrfd:
+
+        # lock changes are signalled as frontend events
+        fe_poller = select.poll()
+        fe_poller.register(fefd, select.POLLIN | select.POLLPRI)
+
+        # we will need to poll the DVR, level triggered since a wake-up doesn't necessarily
+        # drain it completely
+        dvr_poller = DvrPoller(dvrfd.fileno())
 
         # set appropriate buffer size
-        # MPEG-TS are chopped into (at most) 188 sections
-        ts_length = 189
-        ts_buffer = ts_length * 2048
-        LOGGER.debug("Setting demuxer buffer size to %d", ts_buffer)
-        if fcntl.ioctl(dmxfd, DMX_SET_BUFFER_SIZE, ts_buffer) != 0:
-            LOGGER.error("DMX_SET_BUFFER_SIZE failed, aborting")
-            exit(1)
+        # use about 2MiB, rounded down to a whole number of MPEG-TS packets
+        # with DMX_OUT_TS_TAP the demuxer writes into the DVR ring buffer, so this has to be
+        # set on the DVR device, the demuxer's own filter buffer isn't used at all
+        ts_buffer = (2 << 20) // TS_PACKET_SIZE * TS_PACKET_SIZE
+        LOGGER.debug("Setting DVR buffer size to %d", ts_buffer)
+        try:
+            fcntl.ioctl(dvrfd, DMX_SET_BUFFER_SIZE, ts_buffer)
+        except OSError as e:
+            LOGGER.error("DMX_SET_BUFFER_SIZE failed, aborting: %s", e)
+            sys.exit(1)
+
+        # the payload is never inspected, so read into a preallocated buffer and only count bytes
+        buf = bytearray(ts_buffer)
+        mv = memoryview(buf)
 
         # timeout for polling
-        frequencies_count = len(frequency_list(config.frequencies))
+        frequencies = config.frequency_tunables
+        frequencies_count = len(frequencies)
         timeout = config.step / frequencies_count
+        timeout_ns = int(timeout * 1000000000)
         LOGGER.debug("Spending about %ds per frequency with data retrieval", timeout)
-        
+
+        # tags never change, so build them once per frequency
+        tags = {tunable: influx_tags(tunable) for tunable in frequencies}
+
+        # points waiting to be written to influxdb
+        pending_points = collections.deque(maxlen=INFLUX_MAX_PENDING)
+        last_flush = time.monotonic()
+        # docker stop sends SIGTERM, don't lose the points held back until the next flush
+        atexit.register(write_pending, client, pending_points)
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+        # the frontend keeps its lock between scan cycles, so remember what it is tuned to
+        current_tunable = None
+
         LOGGER.debug("--- begin main loop ---")
 
         # begin main loop
         while True:
             
             LOGGER.info("Start new scan cycle (%d frequencies)", frequencies_count)
-            total_start_time = datetime.datetime.now()
+            # use a monotonic clock, wall-clock jumps must not affect the scheduling
+            total_start_time = time.monotonic()
             total_speed = 0
 
             # prepare message array for sending to influxdb
             influx_messages = []
             
+            # the filter is the same for all frequencies, so the demuxer keeps running while
+            # retuning and only needs to be started once per scan cycle
+            demuxer_started = start_demuxer(dmxfd) == 0
+
             # for debugging
             num = 0
             # iterate over all given frequency and modulation paris
-            for tunable in frequency_list(config.frequencies):
-                # try to tune and start the filter process
+            for tunable in frequencies:
+                # try to tune
                 count = 0
                 num += 1
-                if tune(fefd, tunable, config.locktime, num, frequencies_count)  != 0 or start_demuxer(dmxfd) != 0:
-                    break
+                # the lock may have been lost since the last cycle, retune in that case
+                if tunable == current_tunable and not has_lock(fefd):
+                    LOGGER.warning("  frontend lost its lock on frequency %dMHz, retuning",
+                        tunable.frequency)
+                    current_tunable = None
+                if tunable == current_tunable:
+                    if debug_enabled:
+                        LOGGER.debug("%d/%d: already tuned to frequency %dMHz", num,
+                            frequencies_count, tunable.frequency)
+                    # nothing to wait for, but leftovers in the DVR must not be counted
+                    drain_dvr(dvrfd, mv)
+                elif (
+                    tune(fefd, tunable, num, frequencies_count) != 0
+                    or wait_for_lock(fefd, fe_poller, dvrfd, mv, config.locktime) != 0
+                ):
+                    current_tunable = None
+                else:
+                    current_tunable = tunable
+                if current_tunable is None or not demuxer_started:
+                    # a single frequency failing must not cost the others their measurement,
+                    # record the failure so it shows up as such in the database
+                    influx_messages.append(
+                        {
+                            "measurement": "pydtm",
+                            "tags": dict(tags[tunable], lock="failed"),
+                            "fields": {
+                                "speed": 0.0,
+                            },
+                            "time": time.time_ns() // 1000000,
+                        }
+                    )
+                    continue
 
                 # make sure we spend at most (step / number of frequencies) second per frequency
-                start_time = timeit.default_timer()
-                end_time = start_time
-                while (end_time - start_time) < timeout:
+                start_time = time.monotonic_ns()
+                deadline = start_time + timeout_ns
+                remaining = timeout
+                while remaining > 0:
                     # interrupting a poll() system call will cause a traceback
-                    # using try/except will suppress that for SIGTERM, but not for SIGINT
-                    # (Python got it"s own SIGINT handler)
+                    # SIGTERM and SIGINT raise their own exceptions and end the program
                     try:
-                        events = dvr_poller.poll(timeout * 1000)
+                        readable = dvr_poller.poll(remaining)
                     except IOError:
                         LOGGER.warning("  event polling was interrupted", exc_info=True)
-                        # try to stop the demuxer
-                        stop_demuxer(dmxfd)
+                        current_tunable = None
                         break
 
-                    for _, flag in events:
-                        if flag & (select.POLLIN | select.POLLPRI):
-                            data = dvrfd.read(ts_buffer)
-                            count += len(data)
-                            end_time = timeit.default_timer()
+                    if readable:
+                        # read a limited batch, so a busy frequency can't overrun its time slot
+                        count += drain_dvr(dvrfd, mv, DVR_DRAIN_LIMIT)
+                    # never wait longer than what is left of this frequency's time slot
+                    remaining = (deadline - time.monotonic_ns()) / 1000000000
                 # record final end time
-                elapsed = timeit.default_timer() - start_time
-
-                # stop filtering
-                if stop_demuxer(dmxfd) != 0:
-                    break
+                elapsed_ns = time.monotonic_ns() - start_time
+                elapsed = elapsed_ns / 1000000000
 
                 # append data to infuxdb message
-                if tunable.modulation == QAM_256:
-                    m_type = "qam256"
-                else:
-                    m_type = "qam64"
+                speed = round((count * 8) / elapsed / 1024, 2)
+                timestamp = time.time_ns() // 1000000
                 influx_messages.append(
                     {
                         "measurement": "pydtm",
-                        "tags":{
-                            "name": "{}.{}".format(m_type,tunable.frequency),
-                            "frequency": tunable.frequency,
-                            "modulation": m_type,
-                        },
+                        "tags": tags[tunable],
+                        # raw values allow the rate to be derived in queries as well
                         "fields": {
-                            "speed":round((count * 8 / elapsed) / 1024, 2),
+                            "speed": speed,
+                            "bytes": count,
+                            "elapsed_ms": elapsed_ns // 1000000,
                         },
-                        "time":int(round(time.time() * 1000)),
+                        "time": timestamp,
                     }
                 )
 
                 # for debugging purposes, output data
-                LOGGER.debug(
-                    "  frequency %d done: spent %fs, got %d packets (%d bytes) equaling a rate"
-                    "of %fkBit/s",
-                    tunable.frequency,
-                    elapsed,
-                    len(data) / ts_length,
-                    len(data),
-                    round((count * 8) / elapsed / 1024, 2),
-                )
-                total_speed += round((count * 8) / elapsed / 1024, 2)
-
-            total_time_diff = datetime.datetime.now() - total_start_time
+                if debug_enabled:
+                    LOGGER.debug(
+                        "  frequency %d done: spent %fs, got %d packets (%d bytes) equaling a rate"
+                        "of %fkBit/s",
+                        tunable.frequency,
+                        elapsed,
+                        count // TS_PACKET_SIZE,
+                        count,
+                        speed,
+                    )
+                total_speed += speed
+
+            # stop filtering until the next scan cycle
+            if demuxer_started:
+                stop_demuxer(dmxfd)
+
+            total_time_diff = time.monotonic() - total_start_time
             LOGGER.info("Scan completed in %ds (%d/%d frequencies, %.2f MB/s total).", 
-                total_time_diff.seconds,
-                #datetime.datetime.strftime(total_time_diff, "%M:%S"),
+                total_time_diff,
                 num,
                 frequencies_count,
                 total_speed / 1024
             )
 
-            # send data
-            LOGGER.info("Sending data to database...")
+            # send data once enough points are pending or the flush interval is over,
+            # points which could not be written are kept for the next attempt
             LOGGER.debug("Data: %s", influx_messages)
-            try:
-                client.write_points(influx_messages, time_precision='ms')
-            except Exception as e:
-                LOGGER.error(
-                    f"Error sending to database: {e}"
+            dropped = len(pending_points) + len(influx_messages) - INFLUX_MAX_PENDING
+            if dropped > 0:
+                LOGGER.warning(
+                    "Too many points pending, dropping the %d oldest ones", dropped
                 )
-                
+            pending_points.extend(influx_messages)
+            if (
+                len(pending_points) >= INFLUX_BATCH_SIZE
+                or time.monotonic() - last_flush >= config.influx_flush
+            ):
+                if write_pending(client, pending_points):
+                    last_flush = time.monotonic()
+            else:
+                LOGGER.debug("Holding back %d points until next flush", len(pending_points))
+
 
-            sleeptime = (config.interval - total_time_diff.seconds)
+            sleeptime = (config.interval - total_time_diff)
             if sleeptime > 0:
                 nextRun = datetime.datetime.now() + datetime.timedelta(seconds=sleeptime)
                 LOGGER.info("Scheduled next run at %s (sleep %ds)",